@@ -35,6 +35,8 @@ from datetime import datetime
 from typing import Dict, List, Tuple, Optional
 from dataclasses import dataclass, asdict
 import time
+import queue
+import threading
 
 
 def install_packages():
@@ -57,6 +59,73 @@ def install_packages():
             print(f"✗ Failed to install {package}")
 
 
+# Model tiers, smallest first. A prompt is sent to the first tier whose
+# max_input_tokens it fits in. Prices are USD per 1M tokens.
+MODEL_TIERS = [
+    {
+        'name': 'gemini-1.5-flash-8b',
+        'max_input_tokens': 2000,
+        'input_price': 0.0375,
+        'output_price': 0.15,
+        'base_latency_s': 1.5,
+        'output_tokens_per_s': 250
+    },
+    {
+        'name': 'gemini-1.5-flash',
+        'max_input_tokens': 8000,
+        'input_price': 0.075,
+        'output_price': 0.30,
+        'base_latency_s': 2.0,
+        'output_tokens_per_s': 180
+    },
+    {
+        'name': 'gemini-1.5-pro',
+        'max_input_tokens': None,
+        'input_price': 1.25,
+        'output_price': 5.00,
+        'base_latency_s': 4.0,
+        'output_tokens_per_s': 60
+    }
+]
+
+# Expected size of the JSON persona returned by the model
+EXPECTED_OUTPUT_TOKENS = 1500
+
+# Users with less text than this skip the LLM and get a local minimal persona
+MIN_CONTENT_CHARS = 300
+
+# The post/comment sections grow to fill the per-user budget, so the budget
+# also decides the largest tier a user can reach (pro needs more than 8000)
+DEFAULT_PER_USER_TOKEN_BUDGET = 6000
+DEFAULT_BATCH_TOKEN_BUDGET = 100000
+
+# /api/info accepts up to 100 fullnames per request
+INFO_BATCH_SIZE = 100
+
+# Parent text shown next to each comment in the prompt is cut to this length.
+# It doesn't count against the comment section cap, which is for the user's own text.
+PARENT_CONTEXT_CHARS = 80
+
+# Max Reddit requests a generator may spend on parent context resolution
+DEFAULT_BATCH_REQUEST_BUDGET = 50
+
+
+@dataclass
+class PreflightEstimate:
+    """Token, cost and latency estimate for one user's analysis"""
+    username: str
+    content_chars: int
+    prompt_tokens: int
+    model: str
+    estimated_cost_usd: float
+    estimated_latency_s: float
+    skip_llm: bool
+    max_chars_per_section: int
+    skip_reason: str = ''
+    over_budget: bool = False
+    # True when Gemini's count_tokens failed and prompt_tokens is a ~4 chars/token guess
+    tokens_estimated: bool = False
+
 
 @dataclass
 class Citation:
@@ -116,19 +185,33 @@ class UserPersona:
 class RedditUserPersonaGenerator:
     """Main class for generating user personas from Reddit profiles"""
     
-    def __init__(self, reddit_client_id: str = None, reddit_client_secret: str = None, 
-                 reddit_user_agent: str = None, gemini_api_key: str = None):
+    def __init__(self, reddit_client_id: str = None, reddit_client_secret: str = None,
+                 reddit_user_agent: str = None, gemini_api_key: str = None,
+                 per_user_token_budget: int = DEFAULT_PER_USER_TOKEN_BUDGET,
+                 batch_token_budget: int = DEFAULT_BATCH_TOKEN_BUDGET,
+                 batch_request_budget: int = DEFAULT_BATCH_REQUEST_BUDGET):
         """
         Initialize the persona generator
-        
+
         Args:
             reddit_client_id: Reddit app client ID
             reddit_client_secret: Reddit app client secret
             reddit_user_agent: User agent string
             gemini_api_key: Google Gemini API key
+            per_user_token_budget: Max prompt tokens sent to the LLM for one user
+            batch_token_budget: Max prompt + output tokens spent by this generator
+            batch_request_budget: Max Reddit requests spent on parent context by this generator
         """
         self.reddit = self._initialize_reddit(reddit_client_id, reddit_client_secret, reddit_user_agent)
         self._initialize_gemini(gemini_api_key)
+        self.per_user_token_budget = per_user_token_budget
+        self.batch_token_budget = batch_token_budget
+        self.batch_tokens_used = 0
+        self.batch_request_budget = batch_request_budget
+        self.batch_requests_used = 0
+        self._budget_lock = threading.Lock()
+        # Parent fullname -> short text, shared across users since popular threads overlap
+        self._parent_cache: Dict[str, str] = {}
         
     def _initialize_reddit(self, client_id: str, client_secret: str, user_agent: str) -> praw.Reddit:
         """Initialize Reddit API client"""
@@ -156,7 +239,14 @@ class RedditUserPersonaGenerator:
         
         genai.configure(api_key=api_key)
         self.gemini_model = genai.GenerativeModel('gemini-1.5-flash')
-    
+        self._gemini_models = {'gemini-1.5-flash': self.gemini_model}
+
+    def _get_model(self, model_name: str) -> genai.GenerativeModel:
+        """Return a cached Gemini model for the given tier"""
+        if model_name not in self._gemini_models:
+            self._gemini_models[model_name] = genai.GenerativeModel(model_name)
+        return self._gemini_models[model_name]
+
     def extract_username_from_url(self, url: str) -> str:
         """Extract username from Reddit profile URL"""
         patterns = [
@@ -223,25 +313,246 @@ class RedditUserPersonaGenerator:
             print(f"❌ Error scraping user data: {e}")
             return None
     
-    def analyze_with_gemini(self, user_data: Dict) -> Dict:
-        """Use Gemini AI to analyze user data and extract persona characteristics"""
-        
-        # Prepare content for analysis
-        posts_text = "\n".join([f"POST: {post['title']} - {post['content']}" 
-                               for post in user_data['posts'] if post['content']])
-        comments_text = "\n".join([f"COMMENT: {comment['content']}" 
-                                  for comment in user_data['comments']])
-        
-        # Prepare subreddit activity
+    def _format_parent_text(self, thing) -> str:
+        """Short text for a parent comment or submission"""
+        if isinstance(thing, praw.models.Comment):
+            text = thing.body
+        else:
+            text = f"{thing.title} - {thing.selftext}" if thing.selftext else thing.title
+        text = " ".join(text.split())
+        if len(text) > PARENT_CONTEXT_CHARS:
+            text = text[:PARENT_CONTEXT_CHARS] + "..."
+        return text
+
+    def resolve_parent_context(self, user_data: Dict):
+        """Attach a short parent text to each comment, resolving parents in bulk
+
+        Parent ids not already cached are fetched via /api/info in batches of
+        up to INFO_BATCH_SIZE, within the generator's request budget. Users
+        who will skip the LLM for lack of content are left alone.
+        """
+        if not self._has_enough_content(user_data):
+            return
+
+        parent_ids = list(dict.fromkeys(
+            comment['parent_id'] for comment in user_data['comments'] if comment.get('parent_id')
+        ))
+        missing = [parent_id for parent_id in parent_ids if parent_id not in self._parent_cache]
+
+        if missing:
+            print(f"🧵 Resolving {len(missing)} parent comments/posts "
+                  f"({len(parent_ids) - len(missing)} cached)...")
+
+        for i in range(0, len(missing), INFO_BATCH_SIZE):
+            with self._budget_lock:
+                if self.batch_requests_used >= self.batch_request_budget:
+                    print(f"⚠️ Request budget of {self.batch_request_budget} reached, skipping remaining parent context")
+                    break
+                self.batch_requests_used += 1
+
+            batch = missing[i:i + INFO_BATCH_SIZE]
+            try:
+                for thing in self.reddit.info(fullnames=batch):
+                    self._parent_cache[thing.fullname] = self._format_parent_text(thing)
+            except Exception as e:
+                print(f"❌ Error resolving parent context: {e}")
+                break
+
+            # Deleted or inaccessible parents are not returned; don't ask again
+            for parent_id in batch:
+                self._parent_cache.setdefault(parent_id, '')
+
+        for comment in user_data['comments']:
+            comment['parent_context'] = self._parent_cache.get(comment.get('parent_id'), '')
+
+    def _get_top_subreddits(self, user_data: Dict, n: int = 10) -> List[Tuple[str, int]]:
+        """Count posts and comments per subreddit and return the most active ones"""
         subreddit_activity = {}
         for post in user_data['posts']:
             subreddit_activity[post['subreddit']] = subreddit_activity.get(post['subreddit'], 0) + 1
         for comment in user_data['comments']:
             subreddit_activity[comment['subreddit']] = subreddit_activity.get(comment['subreddit'], 0) + 1
-        
-        top_subreddits = sorted(subreddit_activity.items(), key=lambda x: x[1], reverse=True)[:10]
-        
-        prompt = f"""
+
+        return sorted(subreddit_activity.items(), key=lambda x: x[1], reverse=True)[:n]
+
+    def _get_content_chars(self, user_data: Dict) -> int:
+        """Total amount of user-written text available for analysis"""
+        return (sum(len(post['title']) + len(post['content']) for post in user_data['posts']) +
+                sum(len(comment['content']) for comment in user_data['comments']))
+
+    def _has_enough_content(self, user_data: Dict) -> bool:
+        """Whether the user has enough text to be worth an LLM call"""
+        return self._get_content_chars(user_data) >= MIN_CONTENT_CHARS
+
+    def _count_tokens(self, text: str, model_name: str = 'gemini-1.5-flash') -> Tuple[int, bool]:
+        """Count prompt tokens with Gemini
+
+        Returns:
+            (token count, whether it is a ~4 chars/token guess because count_tokens failed)
+        """
+        try:
+            return self._get_model(model_name).count_tokens(text).total_tokens, False
+        except Exception as e:
+            print(f"⚠️ Gemini count_tokens failed ({e}); estimating tokens at ~4 chars/token")
+            return len(text) // 4 + 1, True
+
+    def _select_model_tier(self, prompt_tokens: int) -> Dict:
+        """Pick the smallest model tier that fits the prompt"""
+        for tier in MODEL_TIERS:
+            if tier['max_input_tokens'] is None or prompt_tokens <= tier['max_input_tokens']:
+                return tier
+        return MODEL_TIERS[-1]
+
+    def preflight(self, user_data: Dict, max_chars_per_section: int = None) -> PreflightEstimate:
+        """Count prompt tokens and estimate cost/latency before calling the LLM
+
+        Unless max_chars_per_section is given, the post and comment sections
+        are sized to fill the per-user token budget, then shrunk until the
+        prompt fits. Users with too little text are flagged to skip the LLM
+        and get a minimal persona instead; users whose prompt can't fit the
+        budget are flagged as over budget and fail.
+        """
+        content_chars = self._get_content_chars(user_data)
+
+        def skip(reason: str) -> PreflightEstimate:
+            return PreflightEstimate(
+                username=user_data['username'],
+                content_chars=content_chars,
+                prompt_tokens=0,
+                model='local',
+                estimated_cost_usd=0.0,
+                estimated_latency_s=0.0,
+                skip_llm=True,
+                max_chars_per_section=0,
+                skip_reason=reason
+            )
+
+        if not self._has_enough_content(user_data):
+            return skip(f"only {content_chars} chars of content")
+
+        if max_chars_per_section is None:
+            # Split the tokens left after the template between the two sections
+            # (~4 chars/token). Parent context rides along with the comments
+            # section, so grow its share by the parent/comment text ratio.
+            template_tokens = len(self._build_prompt(user_data, 0)) // 4
+            available_chars = (self.per_user_token_budget - template_tokens) * 4
+            comment_chars = sum(len(comment['content']) for comment in user_data['comments'])
+            parent_chars = sum(len(comment.get('parent_context', '')) + 16
+                               for comment in user_data['comments'] if comment.get('parent_context'))
+            parent_ratio = parent_chars / comment_chars if comment_chars else 0.0
+            max_chars_per_section = max(500, int(available_chars / (2 + parent_ratio)))
+
+        prompt_tokens, tokens_estimated = self._count_tokens(self._build_prompt(user_data, max_chars_per_section))
+
+        # Enforce per-user budget by trimming the post/comment sections
+        while prompt_tokens > self.per_user_token_budget and max_chars_per_section > 500:
+            max_chars_per_section = max(500, int(max_chars_per_section * self.per_user_token_budget / prompt_tokens))
+            prompt_tokens, tokens_estimated = self._count_tokens(self._build_prompt(user_data, max_chars_per_section))
+
+        if prompt_tokens > self.per_user_token_budget:
+            return PreflightEstimate(
+                username=user_data['username'],
+                content_chars=content_chars,
+                prompt_tokens=prompt_tokens,
+                model='none',
+                estimated_cost_usd=0.0,
+                estimated_latency_s=0.0,
+                skip_llm=False,
+                max_chars_per_section=max_chars_per_section,
+                over_budget=True,
+                tokens_estimated=tokens_estimated
+            )
+
+        tier = self._select_model_tier(prompt_tokens)
+        cost = (prompt_tokens * tier['input_price'] + EXPECTED_OUTPUT_TOKENS * tier['output_price']) / 1_000_000
+        latency = tier['base_latency_s'] + EXPECTED_OUTPUT_TOKENS / tier['output_tokens_per_s']
+
+        return PreflightEstimate(
+            username=user_data['username'],
+            content_chars=content_chars,
+            prompt_tokens=prompt_tokens,
+            model=tier['name'],
+            estimated_cost_usd=cost,
+            estimated_latency_s=latency,
+            skip_llm=False,
+            max_chars_per_section=max_chars_per_section,
+            tokens_estimated=tokens_estimated
+        )
+
+    def _generate_minimal_analysis(self, user_data: Dict, reason: str) -> Dict:
+        """Build a persona analysis locally, without the LLM, from plain activity facts
+
+        Args:
+            user_data: Scraped user data
+            reason: Why the LLM was skipped, shown as the reasoning for unknown fields
+        """
+        top_subreddits = self._get_top_subreddits(user_data, n=5)
+        not_analyzed = f"Not analyzed by AI: {reason}"
+        analysis = {key: {'value': 'Unknown', 'reasoning': not_analyzed, 'evidence': []}
+                    for key in ['estimated_age', 'occupation', 'location', 'relationship_status',
+                                'personality_type', 'values', 'communication_style',
+                                'primary_motivations', 'frustrations', 'goals',
+                                'tech_savviness', 'preferred_platforms', 'representative_quote']}
+
+        if top_subreddits:
+            analysis['interests'] = {
+                'value': ", ".join(f"r/{name}" for name, _ in top_subreddits),
+                'reasoning': 'Based on subreddit activity',
+                'evidence': []
+            }
+        else:
+            analysis['interests'] = {'value': 'Unknown', 'reasoning': 'No activity', 'evidence': []}
+
+        # State counts only; the reason for skipping says nothing about how active the user is
+        analysis['online_behavior'] = {
+            'value': f"{len(user_data['posts'])} posts and {len(user_data['comments'])} comments "
+                     f"({self._get_content_chars(user_data)} chars of text) in the scraped history",
+            'reasoning': f"Activity counts only. {not_analyzed}",
+            'evidence': []
+        }
+        analysis['activity_patterns'] = {
+            'value': f"Account is {user_data['account_age_days']:.0f} days old",
+            'reasoning': f"Account age only. {not_analyzed}",
+            'evidence': []
+        }
+
+        # Use the highest scoring comment as the representative quote
+        comments = [c for c in user_data['comments'] if c['content'].strip()]
+        if comments:
+            best = max(comments, key=lambda c: c['score'])
+            analysis['representative_quote'] = {
+                'value': best['content'][:200],
+                'reasoning': 'Highest scoring comment',
+                'evidence': [best['content'][:200]]
+            }
+
+        return analysis
+
+    def _build_comments_section(self, user_data: Dict, max_chars: int) -> str:
+        """Join the user's comments up to max_chars of their own text, plus parent context"""
+        lines = []
+        remaining = max_chars
+        for comment in user_data['comments']:
+            if remaining <= 0:
+                break
+            line = f"COMMENT: {comment['content']}"[:remaining]
+            remaining -= len(line) + 1
+            if comment.get('parent_context'):
+                line = f"[replying to: {comment['parent_context']}] " + line
+            lines.append(line)
+        return "\n".join(lines)
+
+    def _build_prompt(self, user_data: Dict, max_chars_per_section: int = 4000) -> str:
+        """Build the Gemini analysis prompt for a user"""
+
+        # Prepare content for analysis
+        posts_text = "\n".join([f"POST: {post['title']} - {post['content']}"
+                               for post in user_data['posts'] if post['content']])
+        comments_text = self._build_comments_section(user_data, max_chars_per_section)
+
+        top_subreddits = self._get_top_subreddits(user_data)
+
+        return f"""
         Analyze this Reddit user's profile and create a detailed user persona. Based on their posts and comments, extract the following characteristics:
 
         USER DATA:
@@ -253,10 +564,10 @@ class RedditUserPersonaGenerator:
         Top Subreddits: {top_subreddits}
 
         POSTS:
-        {posts_text[:4000]}
+        {posts_text[:max_chars_per_section]}
 
         COMMENTS:
-        {comments_text[:4000]}
+        {comments_text}
 
         Please analyze and provide a JSON response with the following structure. For each characteristic, provide the inferred value and cite specific posts/comments that support your inference. Use actual quotes from the user's content:
 
@@ -345,16 +656,54 @@ class RedditUserPersonaGenerator:
 
         IMPORTANT: 
         - Use ONLY actual quotes from the user's posts and comments as evidence
+        - Text in [replying to: ...] was written by someone else; use it only as context, never as evidence
         - If information is not available or unclear, state "Unknown" for the value
         - Be specific and cite real content, not generic statements
         - Focus on what can be reasonably inferred from the available content
         - Ensure all evidence quotes are actual text from the user's content
         """
-        
+
+    def analyze_with_gemini(self, user_data: Dict, estimate: PreflightEstimate = None) -> Dict:
+        """Use Gemini AI to analyze user data and extract persona characteristics"""
+        if estimate is None:
+            estimate = self.preflight(user_data)
+
+        if estimate.skip_llm:
+            print(f"⏭️ Skipping LLM ({estimate.skip_reason}), generating minimal persona locally")
+            return self._generate_minimal_analysis(user_data, estimate.skip_reason)
+
+        if estimate.over_budget:
+            print(f"❌ Prompt of {estimate.prompt_tokens} tokens can't fit the per-user budget of "
+                  f"{self.per_user_token_budget} tokens, even trimmed to {estimate.max_chars_per_section} "
+                  f"chars per section")
+            return None
+
+        # Reserve tokens up front so concurrent LLM workers can't overrun the budget
+        request_tokens = estimate.prompt_tokens + EXPECTED_OUTPUT_TOKENS
+        with self._budget_lock:
+            budget_exhausted = self.batch_tokens_used + request_tokens > self.batch_token_budget
+            if not budget_exhausted:
+                self.batch_tokens_used += request_tokens
+
+        if budget_exhausted:
+            reason = (f"batch token budget exhausted ({self.batch_tokens_used}/{self.batch_token_budget} used, "
+                      f"{request_tokens} needed)")
+            print(f"⏭️ Skipping LLM ({reason}), generating minimal persona locally")
+            return self._generate_minimal_analysis(user_data, reason)
+
+        prompt = self._build_prompt(user_data, estimate.max_chars_per_section)
+        response = None
+
         try:
-            print("🤖 Analyzing with Gemini AI...")
-            response = self.gemini_model.generate_content(prompt)
-            
+            print(f"🤖 Analyzing with Gemini AI ({estimate.model}, ~{estimate.prompt_tokens} tokens)...")
+            response = self._get_model(estimate.model).generate_content(prompt)
+
+            # Replace the reservation with actual usage when the API reports it
+            usage = getattr(response, 'usage_metadata', None)
+            if usage is not None:
+                with self._budget_lock:
+                    self.batch_tokens_used += usage.prompt_token_count + usage.candidates_token_count - request_tokens
+
             # Clean up the response text to extract JSON
             response_text = response.text.strip()
             
@@ -377,6 +726,10 @@ class RedditUserPersonaGenerator:
             return None
         except Exception as e:
             print(f"❌ Error with Gemini analysis: {e}")
+            # No response means nothing was spent; give the reservation back
+            if response is None:
+                with self._budget_lock:
+                    self.batch_tokens_used -= request_tokens
             return None
     
     def create_citations(self, evidence_quotes: List[str], user_data: Dict) -> List[Citation]:
@@ -561,7 +914,10 @@ KARMA: {persona.karma}
             user_data = self.scrape_user_data(username, limit)
             if not user_data:
                 raise Exception("Failed to scrape user data")
-            
+
+            # Attach parent context to comments
+            self.resolve_parent_context(user_data)
+
             # Analyze with AI
             ai_analysis = self.analyze_with_gemini(user_data)
             if not ai_analysis:
@@ -579,6 +935,245 @@ KARMA: {persona.karma}
             print(f"❌ Error generating persona: {e}")
             return None
 
+    def estimate_batch(self, profile_urls: List[str], limit: int = 100) -> List[PreflightEstimate]:
+        """Dry run: scrape users and estimate tokens, cost and latency without calling the LLM"""
+        estimates = []
+        for profile_url in profile_urls:
+            try:
+                username = self.extract_username_from_url(profile_url)
+            except ValueError as e:
+                print(f"❌ {e}")
+                continue
+
+            user_data = self.scrape_user_data(username, limit)
+            if not user_data:
+                continue
+            self.resolve_parent_context(user_data)
+            estimates.append(self.preflight(user_data))
+
+        print("\n📐 Pre-flight estimate:")
+        for est in estimates:
+            guessed = " (guessed, count_tokens failed)" if est.tokens_estimated else ""
+            if est.skip_llm:
+                print(f"   u/{est.username}: {est.skip_reason} -> local minimal persona")
+            elif est.over_budget:
+                print(f"   u/{est.username}: {est.prompt_tokens} tokens{guessed} exceeds per-user budget of "
+                      f"{self.per_user_token_budget} -> will fail")
+            else:
+                print(f"   u/{est.username}: {est.prompt_tokens} tokens{guessed} -> {est.model} | "
+                      f"${est.estimated_cost_usd:.5f} | ~{est.estimated_latency_s:.1f}s")
+
+        total_tokens = sum(est.prompt_tokens + EXPECTED_OUTPUT_TOKENS for est in estimates
+                           if not est.skip_llm and not est.over_budget)
+        total_cost = sum(est.estimated_cost_usd for est in estimates)
+        total_latency = sum(est.estimated_latency_s for est in estimates)
+        print(f"   TOTAL: {total_tokens} tokens | ${total_cost:.5f} | ~{total_latency:.1f}s LLM time")
+        if any(est.tokens_estimated for est in estimates):
+            print("⚠️ Some token counts are guesses because Gemini's count_tokens failed; check your API key and quota")
+        if total_tokens > self.batch_token_budget - self.batch_tokens_used:
+            print(f"⚠️ Batch exceeds token budget of {self.batch_token_budget}; once it is spent, remaining "
+                  f"users get a minimal local persona (which ones depends on LLM worker order)")
+
+        return estimates
+
+
+# Workers per pipeline stage. PRAW is not thread-safe, so keep scrape at 1
+# unless each worker gets its own Reddit client.
+DEFAULT_STAGE_CONCURRENCY = {
+    'scrape': 1,
+    'pack': 1,
+    'llm': 2,
+    'cite': 1,
+    'write': 1
+}
+
+# Max jobs waiting in front of each stage
+DEFAULT_QUEUE_SIZE = 4
+
+
+@dataclass
+class StageMetrics:
+    """Throughput and queue-depth statistics for one pipeline stage"""
+    name: str
+    workers: int
+    items: int = 0
+    failures: int = 0
+    busy_s: float = 0.0
+    queue_depth_total: int = 0
+    queue_depth_samples: int = 0
+    max_queue_depth: int = 0
+
+    @property
+    def avg_queue_depth(self) -> float:
+        if not self.queue_depth_samples:
+            return 0.0
+        return self.queue_depth_total / self.queue_depth_samples
+
+
+class PersonaPipeline:
+    """Run scrape, pack, LLM, citation and write stages concurrently
+
+    Stages are connected by bounded queues, so while one user is being
+    analyzed the next ones are scraped and finished personas are written
+    in the background. A stage whose workers stay busy while its input
+    queue stays full is the bottleneck.
+    """
+
+    _DONE = object()
+
+    def __init__(self, generator: RedditUserPersonaGenerator, limit: int = 100,
+                 concurrency: Dict[str, int] = None, queue_size: int = DEFAULT_QUEUE_SIZE):
+        """
+        Initialize the pipeline
+
+        Args:
+            generator: Generator whose scraping, analysis and output methods are used
+            limit: Max posts and comments scraped per user
+            concurrency: Workers per stage, overriding DEFAULT_STAGE_CONCURRENCY
+            queue_size: Max jobs waiting in front of each stage
+        """
+        concurrency = concurrency or {}
+        unknown = set(concurrency) - set(DEFAULT_STAGE_CONCURRENCY)
+        if unknown:
+            raise ValueError(f"Unknown pipeline stage(s): {', '.join(sorted(unknown))}. "
+                             f"Valid stages: {', '.join(DEFAULT_STAGE_CONCURRENCY)}")
+        for name, workers in concurrency.items():
+            if isinstance(workers, bool) or not isinstance(workers, int) or workers < 1:
+                raise ValueError(f"Stage '{name}' needs at least 1 worker, got {workers!r}")
+        # queue.Queue treats maxsize <= 0 as unbounded
+        if isinstance(queue_size, bool) or not isinstance(queue_size, int) or queue_size < 1:
+            raise ValueError(f"queue_size must be at least 1, got {queue_size!r}")
+
+        self.generator = generator
+        self.limit = limit
+        self.concurrency = dict(DEFAULT_STAGE_CONCURRENCY, **concurrency)
+        self.queue_size = queue_size
+
+        self.stages = [
+            ('scrape', self._scrape),
+            ('pack', self._pack),
+            ('llm', self._analyze),
+            ('cite', self._cite),
+            ('write', self._write)
+        ]
+        self.metrics = {name: StageMetrics(name=name, workers=self.concurrency[name])
+                        for name, _ in self.stages}
+        self._lock = threading.Lock()
+
+    def _scrape(self, job: Dict) -> Optional[Dict]:
+        username = self.generator.extract_username_from_url(job['url'])
+        print(f"👤 Analyzing user: u/{username}")
+        job['user_data'] = self.generator.scrape_user_data(username, self.limit)
+        if not job['user_data']:
+            return None
+        self.generator.resolve_parent_context(job['user_data'])
+        return job
+
+    def _pack(self, job: Dict) -> Optional[Dict]:
+        job['estimate'] = self.generator.preflight(job['user_data'])
+        return job
+
+    def _analyze(self, job: Dict) -> Optional[Dict]:
+        job['ai_analysis'] = self.generator.analyze_with_gemini(job['user_data'], job['estimate'])
+        return job if job['ai_analysis'] else None
+
+    def _cite(self, job: Dict) -> Optional[Dict]:
+        job['persona'] = self.generator.create_persona(job['user_data'], job['ai_analysis'])
+        return job
+
+    def _write(self, job: Dict) -> Optional[Dict]:
+        self.generator.save_persona_to_file(job['persona'])
+        return job
+
+    def _worker(self, stage_index: int, queues: List[queue.Queue], remaining: List[int],
+                results: List[Optional[UserPersona]]):
+        """Process jobs for one stage until the upstream stage is done"""
+        name, func = self.stages[stage_index]
+        metrics = self.metrics[name]
+        in_queue = queues[stage_index]
+        is_last = stage_index == len(self.stages) - 1
+
+        while True:
+            job = in_queue.get()
+            if job is self._DONE:
+                break
+
+            with self._lock:
+                depth = in_queue.qsize()
+                metrics.queue_depth_total += depth
+                metrics.queue_depth_samples += 1
+                metrics.max_queue_depth = max(metrics.max_queue_depth, depth)
+
+            start = time.time()
+            try:
+                job = func(job)
+            except Exception as e:
+                print(f"❌ Error in {name} stage: {e}")
+                job = None
+            elapsed = time.time() - start
+
+            with self._lock:
+                metrics.busy_s += elapsed
+                metrics.items += 1
+                if job is None:
+                    metrics.failures += 1
+
+            if job is None:
+                continue
+            if is_last:
+                results[job['index']] = job['persona']
+            else:
+                queues[stage_index + 1].put(job)
+
+        # The last worker of a stage signals every worker of the next one
+        with self._lock:
+            remaining[stage_index] -= 1
+            stage_finished = remaining[stage_index] == 0
+        if stage_finished and not is_last:
+            next_name = self.stages[stage_index + 1][0]
+            for _ in range(self.concurrency[next_name]):
+                queues[stage_index + 1].put(self._DONE)
+
+    def run(self, profile_urls: List[str]) -> List[Optional[UserPersona]]:
+        """Generate personas for all URLs, returning them in input order (None on failure)"""
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        remaining = [self.concurrency[name] for name, _ in self.stages]
+        results: List[Optional[UserPersona]] = [None] * len(profile_urls)
+
+        threads = []
+        for stage_index, (name, _) in enumerate(self.stages):
+            for i in range(self.concurrency[name]):
+                thread = threading.Thread(target=self._worker, name=f"{name}-{i}", daemon=True,
+                                          args=(stage_index, queues, remaining, results))
+                thread.start()
+                threads.append(thread)
+
+        start = time.time()
+        for index, profile_url in enumerate(profile_urls):
+            queues[0].put({'index': index, 'url': profile_url})
+        for _ in range(self.concurrency['scrape']):
+            queues[0].put(self._DONE)
+
+        for thread in threads:
+            thread.join()
+
+        self.print_metrics(time.time() - start)
+        return results
+
+    def print_metrics(self, total_s: float):
+        """Print per-stage timings and queue depths, and name the bottleneck"""
+        print(f"\n📈 Pipeline metrics ({total_s:.1f}s total):")
+        for metrics in self.metrics.values():
+            print(f"   {metrics.name:<7} workers={metrics.workers} items={metrics.items} "
+                  f"failed={metrics.failures} busy={metrics.busy_s:.1f}s | "
+                  f"queue avg={metrics.avg_queue_depth:.1f} max={metrics.max_queue_depth}/{self.queue_size}")
+
+        # The input URLs are queued up front, so the scrape queue is always
+        # full; rank stages by per-worker busy time instead of queue depth alone
+        bottleneck = max(self.metrics.values(), key=lambda m: m.busy_s / m.workers)
+        print(f"   Bottleneck: {bottleneck.name} stage "
+              f"({bottleneck.busy_s / bottleneck.workers / max(total_s, 1e-9):.0%} busy per worker)")
+
 
 def setup_credentials():
     """Interactive setup for API credentials"""
@@ -649,6 +1244,39 @@ def generate_persona(profile_url: str, limit: int = 100):
         print(f"❌ Error: {e}")
         return None
 
+def estimate_batch_cost(profile_urls: List[str], limit: int = 100,
+                        batch_token_budget: int = DEFAULT_BATCH_TOKEN_BUDGET):
+    """Dry run for a batch of profiles - prints token, cost and latency estimates"""
+    try:
+        generator = RedditUserPersonaGenerator(batch_token_budget=batch_token_budget)
+        return generator.estimate_batch(profile_urls, limit)
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return None
+
+def generate_personas(profile_urls: List[str], limit: int = 100,
+                      batch_token_budget: int = DEFAULT_BATCH_TOKEN_BUDGET,
+                      concurrency: Dict[str, int] = None) -> List[UserPersona]:
+    """Generate personas for a batch of profiles through the staged pipeline"""
+    try:
+        generator = RedditUserPersonaGenerator(batch_token_budget=batch_token_budget)
+        pipeline = PersonaPipeline(generator, limit=limit, concurrency=concurrency)
+        results = pipeline.run(profile_urls)
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return []
+
+    personas = []
+    for profile_url, persona in zip(profile_urls, results):
+        if persona:
+            print(f"✅ Completed: u/{persona.username}")
+            personas.append(persona)
+        else:
+            print(f"❌ Failed: {profile_url}")
+
+    print(f"\n🔢 Tokens used: {generator.batch_tokens_used}/{generator.batch_token_budget}")
+    return personas
+
 
 
 # In[65]:
@@ -665,16 +1293,16 @@ sample_users = [
     "https://www.reddit.com/user/Hungry-Move-6603/"
 ]
 
-for i, user_url in enumerate(sample_users, 1):
-    print(f"\n[{i}/{len(sample_users)}] Analyzing: {user_url}")
-    try:
-        persona = generate_persona(user_url)
-        if persona:
-            print(f"✅ Completed: u/{persona.username}")
-        else:
-            print(f"❌ Failed: {user_url}")
-    except Exception as e:
-        print(f"❌ Error with {user_url}: {e}")
+# Run with --dry-run to only print the pre-flight estimate for sample_users
+# (scrapes and counts tokens with Gemini, but generates no personas)
+if '--dry-run' in sys.argv:
+    estimate_batch_cost(sample_users)
+    sys.exit(0)
+
+try:
+    generate_personas(sample_users)
+except Exception as e:
+    print(f"❌ Error: {e}")
 
 print("\n🏁 Sample generation completed!")
 